@@ -1,16 +1,29 @@
 import asyncio
 
 import hijacknet
+
+async def ainput(prompt: str) -> str:
+  """input(), but run on a worker thread so that it doesn't block the event loop"""
+  return await asyncio.get_running_loop().run_in_executor(None, input, prompt)
+
 async def main():
-  async with await hijacknet.HijackClient.connect(input("name: "), input("lobby: ")) as client:
+  async with await hijacknet.HijackClient.connect(await ainput("name: "), await ainput("lobby: ")) as client:
     side = await client.read_message()
+    board = await client.read_message()
     print(f"Playing as {side}")
 
-    while type(message := await client.read_message()) == list:
+    while type(message := await client.read_message()) == dict:
       print(message)
-      print("\n".join(" ".join(i) for i in message))
-      x = int(input("x: "))
-      y = int(input("y: "))
+      # Apply our opponent's move, if they have had one yet
+      if message["move"] is not None:
+        their_y, their_x, their_side = message["move"]
+        board[their_y][their_x] = their_side
+      print("\n".join(" ".join(i) for i in board))
+      x = int(await ainput("x: "))
+      y = int(await ainput("y: "))
       await client.send_message([y, x])
+      # The server forfeits moves off the board, so only keep our copy of the ones it can accept
+      if 0 <= y < 3 and 0 <= x < 3:
+        board[y][x] = side
     print(message)
-asyncio.run(main())
+hijacknet.run(main())
@@ -1,10 +1,16 @@
-import asyncio
-import itertools
 from typing import Tuple, List
 
 import hijacknet
 import random
 
+# Each side's squares are kept as a 9-bit mask, with square (y, x) at bit 3 * y + x
+WIN_MASKS = [
+  0b000000111, 0b000111000, 0b111000000,  # rows
+  0b001001001, 0b010010010, 0b100100100,  # columns
+  0b100010001, 0b001010100,               # diagonals
+]
+FULL_BOARD = 0b111111111
+
 class NoughtsAndCrossesServerHandler(hijacknet.HijackServerHandler):
   def check_lobby_complete(self, lobby: hijacknet.HijackLobby) -> bool:
     print(f"{len(lobby.members)} in {lobby.lobby_id}")
@@ -15,52 +21,60 @@ class NoughtsAndCrossesServerHandler(hijacknet.HijackServerHandler):
     random.shuffle(members)
     players = [("X", members[0]), ("O", members[1])]
 
-    # Tell each side who's who
-    await asyncio.gather(*[client.send_message(side) for side, client in players])
-
-    # Initialise the board
+    # Tell each side who's who, along with the starting board. After this, clients keep their own copy up to date
     board = [["_" for x in range(3)] for y in range(3)]
+    await hijacknet.broadcast([client.send_messages([side, board]) for side, client in players])
 
-    print(f"lobby {lobby.lobby_id} ready!")
+    # Initialise the board, with one mask per player
+    masks = [0, 0]
+    last_move = None
 
-    async def call_game(maybe_winner_no: int, is_draw: bool) -> None:
-      mayber_loser_no = (player_no + 1) % 2
-      if is_draw:
-        await asyncio.gather(members[maybe_winner_no].send_message(0.5),
-                             members[mayber_loser_no].send_message(0.5))
-      else:
-        await asyncio.gather(members[maybe_winner_no].send_message(1.),
-                             members[mayber_loser_no].send_message(0.))
+    print(f"lobby {lobby.lobby_id} ready!")
 
+    # These are the last messages of the game, and closing the connections afterwards flushes them, so don't wait
+    def call_game(maybe_winner_no: int, is_draw: bool) -> None:
+      mayber_loser_no = maybe_winner_no ^ 1
+      # A draw is the same message for both players, so only encode it once
+      draw = hijacknet.HijackClient.prepare_message(0.5) if is_draw else None
+      for recipient_no, result in ((maybe_winner_no, 1.), (mayber_loser_no, 0.)):
+        try:
+          if draw is not None:
+            members[recipient_no].send_prepared_nowait(draw)
+          else:
+            members[recipient_no].send_message_nowait(result)
+        except ConnectionResetError:
+          # They've already gone, but the other player should still hear how the game ended
+          pass
 
-    for player_no in itertools.cycle(range(2)):
+    player_no = 0
+    while True:
       side, client = players[player_no]
-      opponent_player_no = (player_no + 1) % 2
+      opponent_player_no = player_no ^ 1
 
-      # Tell the client it's their turn
-      await client.send_message(board)
-      coords = await client.read_message()
+      # Tell the client it's their turn, and what their opponent just played
+      await client.send_message({"move": last_move})
+      y, x = await client.read_message()
       # Autolose on invalid move
-      if board[coords[0]][coords[1]] != "_":
-        await call_game(opponent_player_no, False)
+      if not (0 <= y < 3 and 0 <= x < 3) or (masks[0] | masks[1]) >> (3 * y + x) & 1:
+        call_game(opponent_player_no, False)
         return
-      board[coords[0]][coords[1]] = side
+      masks[player_no] |= 1 << (3 * y + x)
+      last_move = [y, x, side]
       # We only need to check the side that just played
-      for step in range(3):
-        if all([i == side for i in board[step]]) or \
-           all([i[step] == side for i in board]) or \
-           all([board[i][2-i] == side for i in range(2)]) or \
-           all([board[2-i][i] == side for i in range(2)]):
-          await call_game(player_no, False)
-          return
+      mask = masks[player_no]
+      if any(mask & line == line for line in WIN_MASKS):
+        call_game(player_no, False)
+        return
 
       # If the board is full and no-one has won, it's a draw
-      if all(i != "_" for j in board for i in j):
-        await call_game(player_no, True)
+      if masks[0] | masks[1] == FULL_BOARD:
+        call_game(player_no, True)
         return
 
+      player_no ^= 1
+
 async def main():
   server = hijacknet.HijackServer(NoughtsAndCrossesServerHandler())
   await server.run()
 
-asyncio.run(main())
\ No newline at end of file
+hijacknet.run(main())
\ No newline at end of file
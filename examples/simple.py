@@ -6,9 +6,10 @@ server: hijacknet.HijackServer
 
 class SimpleServerHandler(hijacknet.HijackServerHandler):
   async def run_lobby_inner(self, lobby: hijacknet.HijackLobby, client: hijacknet.HijackClient):
+    others = lobby.get_other_members(client)
     while (message := await client.read_message()) is not None:
-      await asyncio.gather(*[i.send_message({"sender": client.name, "body": message})
-                             for i in lobby.get_other_members(client)])
+      prepared = hijacknet.HijackClient.prepare_message({"sender": client.name, "body": message})
+      await hijacknet.broadcast([i.send_prepared(prepared) for i in others])
     # Stop the whole server after both clients disconnect
     await server.stop()
 
@@ -30,4 +31,4 @@ async def main():
   server = hijacknet.HijackServer(SimpleServerHandler())
   await asyncio.gather(server.run(), client("alice"), client("bob"))
 
-asyncio.run(main())
\ No newline at end of file
+hijacknet.run(main())
\ No newline at end of file
@@ -2,21 +2,278 @@
 #
 # SPDX-License-Identifier: MIT
 import asyncio
-import json
-import warnings
+import socket
+import struct
+import sys
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, Optional, Awaitable, Tuple, Iterator, Union, ValuesView, List
+from collections import deque
+from typing import (Any, Callable, Coroutine, Dict, Optional, Awaitable, Tuple, Iterator, Union, ValuesView, List,
+                    Sequence, Iterable, TypeVar, cast)
+
+import msgspec
 
 # https://github.com/python/typing/issues/182#issuecomment-1259412066
 Jsonable = Union[dict[str, 'Jsonable'], list['Jsonable'], str, int, float, bool, None]
 
 default_port = 42042
 
+# Every frame is a big-endian payload length, followed by that many bytes of msgpack
+_frame_header = struct.Struct('>I')
+
+_T = TypeVar("_T")
+
+def run(main: Coroutine[Any, Any, _T]) -> _T:
+  """
+  Runs a coroutine to completion like asyncio.run(), using uvloop's faster event loop if it is installed
+  :param main: The coroutine to run, usually main()
+  :return: Whatever the coroutine returned
+  """
+  try:
+    import uvloop
+  except ImportError:
+    return asyncio.run(main)
+  if sys.version_info >= (3, 11):
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+      return runner.run(main)
+  uvloop.install()
+  return asyncio.run(main)
+
+async def broadcast(aws: Sequence[Awaitable[None]]) -> None:
+  """
+  Waits for a batch of sends (or other awaitables) concurrently.
+  A lone awaitable is awaited directly, avoiding the task creation asyncio.gather would do for it.
+  :param aws: The awaitables to wait for, e.g. a list of send_message() calls
+  """
+  if len(aws) == 1:
+    await aws[0]
+  else:
+    await asyncio.gather(*aws)
+
+class _HijackProtocol(asyncio.BufferedProtocol):
+  """
+  Splits the incoming byte stream into frames, and provides stream-style flow control for writes.
+  Completed frames are queued for read_frame(), with None marking the end of the stream.
+  """
+  __slots__ = ('_on_connected', '_task', '_transport', '_transport_lost', '_recv_buffer', '_pending', '_large_frame',
+               '_large_size', '_large_received', '_incoming', '_queued', '_reading_paused', '_eof', '_paused',
+               '_drain_waiters', '_closed')
+
+  _on_connected: Optional[Callable[["_HijackProtocol"], Coroutine[Any, Any, None]]]
+  _task: Optional[asyncio.Task]
+  # Set by connection_made(), which the event loop always calls before anything else
+  _transport: asyncio.Transport
+  _large_frame: Optional[bytearray]
+  _large_size: int
+  _large_received: int
+  _incoming: "asyncio.Queue[Optional[Union[bytes, bytearray]]]"
+  # How many bytes of frames are in _incoming
+  _queued: int
+  _reading_paused: bool
+  _eof: bool
+  _drain_waiters: "deque[asyncio.Future[None]]"
+  _closed: "asyncio.Future[None]"
+
+  # The transport reads into this fixed buffer, and we copy out whatever frames it completes.
+  # Frames bigger than this are instead read straight into a buffer of their own, see buffer_updated()
+  _recv_size = 65536
+  # Like StreamReader, stop reading from the peer while more than this has been received but not yet read, and resume
+  # once at most half of it is left. Otherwise a peer could keep sending to a handler that isn't reading, without limit
+  _queue_high = 2 * _recv_size
+  # The header allows frames of up to 4 GiB, which is far more than we're willing to buffer for anyone
+  _max_frame_size = 64 * 1024 * 1024
+
+  def connection_made(self, transport: asyncio.BaseTransport) -> None:
+    self._transport = cast(asyncio.Transport, transport)
+    # Our messages are small and latency sensitive, so never let Nagle's algorithm hold them back
+    sock = transport.get_extra_info('socket')
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if self._on_connected is not None:
+      self._task = asyncio.get_running_loop().create_task(self._on_connected(self))
+      self._task.add_done_callback(self._on_connected_done)
+
+  def _on_connected_done(self, task: asyncio.Task) -> None:
+    # Like asyncio.start_server(), report a failed handler and drop its connection, rather than leaving it open forever
+    if task.cancelled():
+      self._transport.close()
+      return
+    exc = task.exception()
+    if exc is not None:
+      asyncio.get_running_loop().call_exception_handler({
+        "message": "Unhandled exception in hijacknet connection handler",
+        "exception": exc,
+        "transport": self._transport,
+      })
+      self._transport.close()
+
+  def get_buffer(self, sizehint: int) -> memoryview:
+    frame = self._large_frame
+    if frame is not None:
+      if self._large_received == len(frame):
+        # Only ever grow in proportion to what has actually arrived, so that the header alone can't make us allocate
+        # the whole (claimed) size of the frame. This copies rather than resizing in place, as the transport may still
+        # hold the view we handed out last time. Doubling keeps the total copied to about the size of the frame
+        grown = bytearray(min(self._large_size, 2 * len(frame)))
+        grown[:self._large_received] = frame
+        self._large_frame = frame = grown
+      # Never hand out more than is left of the frame, so that the next one still starts in _recv_buffer
+      return memoryview(frame)[self._large_received:]
+    return self._recv_buffer
+
+  def buffer_updated(self, nbytes: int) -> None:
+    if self._large_frame is not None:
+      self._large_received += nbytes
+      if self._large_received == self._large_size:
+        self._incoming.put_nowait(self._large_frame)
+        self._large_frame = None
+        self._queued += self._large_size
+        self._check_queued()
+      return
+
+    pending = self._pending
+    pending += self._recv_buffer[:nbytes]
+    # This runs for every read, so hoist the lookups out of the per-frame loop
+    available = len(pending)
+    header_size = _frame_header.size
+    unpack_header = _frame_header.unpack_from
+    put_frame = self._incoming.put_nowait
+    queued = self._queued
+    offset = 0
+    with memoryview(pending) as view:
+      while available - offset >= header_size:
+        start = offset + header_size
+        end = start + unpack_header(pending, offset)[0]
+        if end > available:
+          break
+        put_frame(bytes(view[start:end]))
+        queued += end - start
+        offset = end
+    del pending[:offset]
+    self._queued = queued
+    self._check_queued()
+
+    # If what's left is the start of a large frame, have the transport read the rest of it into a buffer of its own,
+    # which becomes the frame once it is full. This saves appending every read to _pending and copying the frame out
+    if len(pending) >= header_size:
+      size = unpack_header(pending)[0]
+      if size > self._max_frame_size:
+        # There's no way to skip the frame without reading it all, so give up on the connection
+        pending.clear()
+        self._transport.abort()
+      elif size > self._recv_size:
+        received = len(pending) - header_size
+        self._large_frame = bytearray(min(size, max(2 * received, 2 * self._recv_size)))
+        self._large_frame[:received] = memoryview(pending)[header_size:]
+        self._large_size = size
+        self._large_received = received
+        pending.clear()
+
+  def _check_queued(self) -> None:
+    if self._queued > self._queue_high and not self._reading_paused:
+      self._reading_paused = True
+      self._transport.pause_reading()
+
+  def _end_of_stream(self) -> None:
+    if not self._eof:
+      self._eof = True
+      self._incoming.put_nowait(None)
+
+  def eof_received(self) -> bool:
+    # The peer has only finished sending, so keep the transport open to let our replies through, like StreamReader.
+    # It gets closed by close(), or by the peer
+    self._end_of_stream()
+    return True
+
+  def connection_lost(self, exc: Optional[Exception]) -> None:
+    self._transport_lost = True
+    self._end_of_stream()
+    while self._drain_waiters:
+      waiter = self._drain_waiters.popleft()
+      if not waiter.done():
+        waiter.set_exception(ConnectionResetError("Connection lost") if exc is None else exc)
+    if not self._closed.done():
+      self._closed.set_result(None)
+
+  def pause_writing(self) -> None:
+    self._paused = True
+
+  def resume_writing(self) -> None:
+    self._paused = False
+    while self._drain_waiters:
+      waiter = self._drain_waiters.popleft()
+      if not waiter.done():
+        waiter.set_result(None)
+
+  def write(self, data: Union[bytes, bytearray]) -> None:
+    if self._transport_lost:
+      raise ConnectionResetError("Connection lost")
+    self._transport.write(data)
+
+  def writelines(self, chunks: Iterable[Union[bytes, bytearray]]) -> None:
+    if self._transport_lost:
+      raise ConnectionResetError("Connection lost")
+    self._transport.writelines(chunks)
+
+  @property
+  def write_blocked(self) -> bool:
+    """True while the transport's write buffer is over its high water mark, and writers should drain()"""
+    return self._paused
+
+  async def drain(self) -> None:
+    """Waits until the transport's write buffer has room again, like StreamWriter.drain()"""
+    if self._transport_lost:
+      raise ConnectionResetError("Connection lost")
+    if not self._paused:
+      return
+    waiter = asyncio.get_running_loop().create_future()
+    self._drain_waiters.append(waiter)
+    await waiter
+
+  async def read_frame(self) -> Optional[Union[bytes, bytearray]]:
+    frame = await self._incoming.get()
+    if frame is None:
+      # Leave the end of stream marker in place, so that later reads see it too
+      self._incoming.put_nowait(None)
+      return None
+    self._queued -= len(frame)
+    if self._reading_paused and self._queued <= self._queue_high // 2:
+      self._reading_paused = False
+      self._transport.resume_reading()
+    return frame
+
+  async def close(self) -> None:
+    self._transport.close()
+    await asyncio.shield(self._closed)
+
+  def __init__(self, on_connected: Optional[Callable[["_HijackProtocol"], Coroutine[Any, Any, None]]] = None):
+    """
+    :param on_connected: If given, a task running this is started on the protocol once it is connected
+    """
+    self._on_connected = on_connected
+    self._task = None
+    self._transport_lost = False
+    self._recv_buffer = memoryview(bytearray(self._recv_size))
+    self._pending = bytearray()
+    self._large_frame = None
+    self._large_size = 0
+    self._large_received = 0
+    self._incoming = asyncio.Queue()
+    self._queued = 0
+    self._reading_paused = False
+    self._eof = False
+    self._paused = False
+    self._drain_waiters = deque()
+    self._closed = asyncio.get_running_loop().create_future()
+
 class HijackClient:
+  __slots__ = ('_metadata', '_starting_metadata', '_protocol')
+
   _metadata: Dict[str, Jsonable]
   _starting_metadata: Optional[Dict[str, Jsonable]]
-  _reader: asyncio.StreamReader
-  _writer: asyncio.StreamWriter
+  _protocol: _HijackProtocol
+
+  _encoder = msgspec.msgpack.Encoder()
+  _decoder = msgspec.msgpack.Decoder()
 
   @property
   def name(self) -> str:
@@ -30,24 +287,73 @@ class HijackClient:
   def others(self) -> List[str]:
     return self._starting_metadata["others"]
 
-  async def _send_message_raw(self, plod: str) -> None:
-    if '\n' in plod:
-      raise Exception("Message payload contained newline")
-    self._writer.write((plod + "\n").encode())
-    await self._writer.drain()
-  async def _read_message_raw(self) -> Optional[str]:
-    res = (await self._reader.readline()).decode()
-    if not res.endswith('\n') or len(res) == 0:
-      return None
-    else:
-      return res
+  @classmethod
+  def _encode_frame(cls, msg: Jsonable) -> bytearray:
+    # Encode straight after a placeholder length prefix, so that the whole frame is one buffer and one write
+    header_size = _frame_header.size
+    frame = bytearray(header_size)
+    cls._encoder.encode_into(msg, frame, header_size)
+    _frame_header.pack_into(frame, 0, len(frame) - header_size)
+    return frame
+
+  # The transport queues up whatever it can't send straight away, so we only need to wait once that queue is full
+  async def _send_message_raw(self, frame: Union[bytes, bytearray]) -> None:
+    protocol = self._protocol
+    protocol.write(frame)
+    if protocol.write_blocked:
+      await protocol.drain()
+  async def _send_messages_raw(self, frames: List[bytearray]) -> None:
+    protocol = self._protocol
+    protocol.writelines(frames)
+    if protocol.write_blocked:
+      await protocol.drain()
+  async def _read_message_raw(self) -> Optional[Union[bytes, bytearray]]:
+    return await self._protocol.read_frame()
 
   async def send_message(self, msg: Jsonable) -> None:
     """
     Sends a message to the remote
     :param msg: The Jsonable message to send
     """
-    await self._send_message_raw(json.dumps(msg, separators=(',', ':')))
+    await self._send_message_raw(self._encode_frame(msg))
+
+  def send_message_nowait(self, msg: Jsonable) -> None:
+    """
+    Queues a message for the remote without ever waiting, even if the remote has fallen behind.
+    Prefer send_message() unless you know that the amount queued up this way will stay small.
+    :param msg: The Jsonable message to send
+    """
+    self._protocol.write(self._encode_frame(msg))
+
+  async def send_messages(self, msgs: Iterable[Jsonable]) -> None:
+    """
+    Sends several messages to the remote in one go, handing them all to the transport in a single write
+    :param msgs: The Jsonable messages to send, in order
+    """
+    await self._send_messages_raw([self._encode_frame(msg) for msg in msgs])
+
+  @classmethod
+  def prepare_message(cls, msg: Jsonable) -> bytes:
+    """
+    Encodes a message once, so that it can be passed to send_prepared() for any number of remotes
+    :param msg: The Jsonable message to encode
+    :return: The encoded message, ready to be sent
+    """
+    return bytes(cls._encode_frame(msg))
+
+  async def send_prepared(self, prepared: bytes) -> None:
+    """
+    Sends a message previously encoded by prepare_message() to the remote
+    :param prepared: The encoded message to send
+    """
+    await self._send_message_raw(prepared)
+
+  def send_prepared_nowait(self, prepared: bytes) -> None:
+    """
+    Queues a message previously encoded by prepare_message() for the remote, like send_message_nowait()
+    :param prepared: The encoded message to send
+    """
+    self._protocol.write(prepared)
 
   async def read_message(self) -> Optional[Jsonable]:
     """
@@ -58,7 +364,7 @@ class HijackClient:
     if msg_raw is None:
       return None
     else:
-      return json.loads(msg_raw)
+      return self._decoder.decode(msg_raw)
 
   async def send_starting_metadata(self, others: List[str]) -> None:
     """
@@ -75,9 +381,7 @@ class HijackClient:
     Disconnects from the remote. You should not call this for server-provided clients,
     and for manually constructed clients, you should be using "async with".
     """
-    self._writer.close()
-    await self._writer.wait_closed()
-    self._reader.feed_eof()
+    await self._protocol.close()
 
   async def __aenter__(self) -> "HijackClient":
     return self
@@ -86,42 +390,39 @@ class HijackClient:
     """A helper function so that we can use "with" for this class"""
     await self.close()
 
-  def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, do_not_call_this_function: int):
+  def __new__(cls, *args, **kwargs):
+    raise Exception("Do not call HijackClient() directly! Use connect() or HijackServer instead")
+
+  @classmethod
+  def _new_internal(cls, protocol: _HijackProtocol) -> "HijackClient":
     """
     Creates an uninitialised remote. DO NOT CALL THIS MANUALLY: use connect() or HijackServer instead
-    :param reader: A read stream for the remote
-    :param writer: A write stream for the remote
+    :param protocol: The connected protocol for the remote
     """
-    # warnings module is not thread safe
-    if do_not_call_this_function != 42:
-      raise Exception("Do not call HijackClient() directly! Use connect() or HijackServer instead")
-
-    self._reader = reader
-    self._writer = writer
-    self._starting_metadata = None
-  @staticmethod
-  async def finish_connect_server(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> "HijackClient":
+    this = object.__new__(cls)
+    this._protocol = protocol
+    this._starting_metadata = None
+    return this
+  @classmethod
+  async def finish_connect_server(cls, protocol: _HijackProtocol) -> "HijackClient":
     """
     Handles the IO for connecting as a server. You should never have to call this manually.
-    :param reader: A read stream for the remote
-    :param writer: A write stream for the remote
+    :param protocol: The connected protocol for the remote
     :return: A HijackRemote object to talk to the remote
     """
-    this = HijackClient(reader, writer, do_not_call_this_function=42)
+    this = cls._new_internal(protocol)
     this._metadata = await this.read_message()
     return this
 
-  @staticmethod
-  async def _finish_connect_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, metadata: Jsonable) -> "HijackClient":
+  @classmethod
+  async def _finish_connect_client(cls, protocol: _HijackProtocol, metadata: Jsonable) -> "HijackClient":
     """
     Handles the IO for connecting as a client. You should never have to call this manually.
-    :param reader: A read stream for the remote
-    :param writer: A write stream for the remote
+    :param protocol: The connected protocol for the remote
     :param metadata: The metadata to send to the remote
     :return: A tuple, containing the (now connected) remote, and the start message automatically sent by the server
     """
-    with warnings.catch_warnings():
-      this = HijackClient(reader, writer, do_not_call_this_function=42)
+    this = cls._new_internal(protocol)
     this._metadata = metadata
     await this.send_message(metadata)
     # Wait for metadata
@@ -138,15 +439,18 @@ class HijackClient:
     :param lobby: The lobby to join/create
     :return: A tuple, containing the (now connected) remote, and the start message automatically sent by the server
     """
-    reader, writer = await asyncio.open_connection(host, port)
-    return await cls._finish_connect_client(reader, writer, metadata={
+    _, protocol = await asyncio.get_running_loop().create_connection(_HijackProtocol, host, port)
+    return await cls._finish_connect_client(protocol, metadata={
       "name": name,
       "lobby": lobby
     })
 
 class HijackLobby:
+  __slots__ = ('lobby_id', '_members', '_others_cache')
+
   lobby_id: str
   _members: Dict[str, HijackClient]
+  _others_cache: Dict[str, Tuple[HijackClient, ...]]
 
   def add_remote(self, remote: HijackClient) -> None:
     """
@@ -156,6 +460,7 @@ class HijackLobby:
     if remote.name in self._members:
       raise Exception("Duplicate name in lobby")
     self._members[remote.name] = remote
+    self._others_cache.clear()
 
   @property
   def members(self) -> ValuesView[HijackClient]:
@@ -171,23 +476,28 @@ class HijackLobby:
     return self._members.get(name)
 
   def __contains__(self, item: Union[str, HijackClient]):
-    if type(item) == HijackClient:
-      excluded = item.name
+    if isinstance(item, HijackClient):
+      item = item.name
     return item in self._members
 
-  def get_other_members(self, excluded: Union[str, HijackClient]) -> Iterator[HijackClient]:
+  def get_other_members(self, excluded: Union[str, HijackClient]) -> Tuple[HijackClient, ...]:
     """
     Convenience function for iterating over "other" members
     :param excluded: The name of the remote to be excluded, or the HijackRemote object itself
     :return: A sequence of remotes that are *not* the excluded member
     """
-    if type(excluded) == HijackClient:
+    if isinstance(excluded, HijackClient):
       excluded = excluded.name
-    return filter(lambda i: i.name != excluded, self._members.values())
+    # Membership only changes through add_remote(), which clears this
+    others = self._others_cache.get(excluded)
+    if others is None:
+      others = self._others_cache[excluded] = tuple(i for name, i in self._members.items() if name != excluded)
+    return others
 
   def __init__(self, lobby_id: str):
     self.lobby_id = lobby_id
     self._members = dict()
+    self._others_cache = dict()
 
 class HijackServerHandler(ABC):
   @abstractmethod
@@ -209,9 +519,9 @@ class HijackServerHandler(ABC):
 
 class HijackServer:
   _sock = None
-  async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+  async def _handle_client(self, protocol: _HijackProtocol) -> None:
     # Handle the server-side connection
-    remote = await HijackClient.finish_connect_server(reader, writer)
+    remote = await HijackClient.finish_connect_server(protocol)
     # Add it to the lobby, creating a new one if it doesn't exist
     lobby = self._building_lobbies.setdefault(remote.lobby, HijackLobby(remote.lobby))
     lobby.add_remote(remote)
@@ -225,20 +535,21 @@ class HijackServer:
     # First, we remote the lobby from the list of unready ones, so that we can't have reentrancy that overfills lobbies
     del self._building_lobbies[remote.lobby]
     # Then we tell all the remotes that they can start in parallel
-    await asyncio.gather(*[remote.send_starting_metadata(list(i.name for i in lobby.get_other_members(remote)))
-                           for remote in lobby.members])
+    await broadcast([remote.send_starting_metadata(list(i.name for i in lobby.get_other_members(remote)))
+                     for remote in lobby.members])
 
     # try:
     # Then we actually dispatch the handler
     await self._handler.run_lobby(lobby)
     # finally:
-    for i in lobby:
-      await i.close()
+    # Close everyone in parallel, and don't let one broken connection stop the rest from being closed
+    await asyncio.gather(*[i.close() for i in lobby], return_exceptions=True)
 
   async def run(self):
     if self._sock is not None:
       raise Exception("Server is already running")
-    self._sock = await asyncio.start_server(self._handle_client, "0.0.0.0", self._port)
+    self._sock = await asyncio.get_running_loop().create_server(lambda: _HijackProtocol(self._handle_client),
+                                                                "0.0.0.0", self._port)
     await self._sock.start_serving()
     await self._sock.wait_closed()
     # await self._sock.serve_forever()
@@ -0,0 +1,3 @@
+# SPDX-FileCopyrightText: 2023-present Cyclic3 <cyclic3.git@gmail.com>
+#
+# SPDX-License-Identifier: MIT
\ No newline at end of file
@@ -0,0 +1,40 @@
+# SPDX-FileCopyrightText: 2023-present Cyclic3 <cyclic3.git@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+import pytest
+
+from hijacknet import HijackClient, HijackLobby
+
+def make_client(name):
+  # Lobbies only look at names, so the client never needs a connection
+  client = HijackClient._new_internal(None)
+  client._metadata = {"name": name, "lobby": "test"}
+  return client
+
+def test_contains_client_and_name():
+  lobby = HijackLobby("test")
+  alice = make_client("alice")
+  lobby.add_remote(alice)
+  assert alice in lobby
+  assert "alice" in lobby
+  assert make_client("bob") not in lobby
+  assert "bob" not in lobby
+
+def test_duplicate_name_rejected():
+  lobby = HijackLobby("test")
+  lobby.add_remote(make_client("alice"))
+  with pytest.raises(Exception, match="Duplicate"):
+    lobby.add_remote(make_client("alice"))
+
+def test_get_other_members_after_add_remote():
+  lobby = HijackLobby("test")
+  alice, bob, carol = make_client("alice"), make_client("bob"), make_client("carol")
+  lobby.add_remote(alice)
+  lobby.add_remote(bob)
+  assert lobby.get_other_members(alice) == (bob,)
+  assert lobby.get_other_members("bob") == (alice,)
+  # The cached results must not outlive a change of membership
+  lobby.add_remote(carol)
+  assert lobby.get_other_members(alice) == (bob, carol)
+  assert lobby.get_other_members("bob") == (alice, carol)
+  assert lobby.get_other_members(carol) == (alice, bob)
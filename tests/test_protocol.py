@@ -0,0 +1,245 @@
+# SPDX-FileCopyrightText: 2023-present Cyclic3 <cyclic3.git@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+import asyncio
+import functools
+import tracemalloc
+from typing import List
+
+import pytest
+
+from hijacknet import HijackClient, Jsonable, _HijackProtocol, _frame_header
+
+MESSAGES: List[Jsonable] = [None, "x", [], 2.5, {"a": [1, 2, 3], "b": "line\nbreak"}, True]
+
+def run_async(test):
+  """Runs an async test on a fresh event loop, as _HijackProtocol needs one to exist"""
+  @functools.wraps(test)
+  def wrapper(*args, **kwargs):
+    return asyncio.run(test(*args, **kwargs))
+  return wrapper
+
+class FakeTransport(asyncio.Transport):
+  def __init__(self):
+    super().__init__()
+    self.written = bytearray()
+    self.closed = False
+    self.reading = True
+
+  def get_extra_info(self, name, default=None):
+    return default
+
+  def write(self, data):
+    self.written += data
+
+  def writelines(self, list_of_data):
+    for data in list_of_data:
+      self.write(data)
+
+  def close(self):
+    self.closed = True
+
+  def abort(self):
+    self.closed = True
+
+  def pause_reading(self):
+    self.reading = False
+
+  def resume_reading(self):
+    self.reading = True
+
+  def is_closing(self):
+    return self.closed
+
+def connected_protocol():
+  protocol = _HijackProtocol()
+  protocol.connection_made(FakeTransport())
+  return protocol
+
+def encode(msgs):
+  return b"".join(HijackClient.prepare_message(msg) for msg in msgs)
+
+def feed(protocol, data, chunk_size):
+  """Delivers data the way a transport would, never writing more than get_buffer() offered"""
+  pos = 0
+  while pos < len(data):
+    buf = protocol.get_buffer(-1)
+    n = min(len(buf), len(data) - pos, chunk_size)
+    buf[:n] = data[pos:pos + n]
+    protocol.buffer_updated(n)
+    pos += n
+
+def received(protocol):
+  frames = []
+  while not protocol._incoming.empty():
+    frames.append(HijackClient._decoder.decode(protocol._incoming.get_nowait()))
+  return frames
+
+@run_async
+async def test_frames_split_at_every_byte_boundary():
+  data = encode(MESSAGES)
+  for split in range(1, len(data)):
+    protocol = connected_protocol()
+    feed(protocol, data[:split], len(data))
+    feed(protocol, data[split:], len(data))
+    assert received(protocol) == MESSAGES, split
+    assert not protocol._pending
+
+@run_async
+async def test_frames_fed_one_byte_at_a_time():
+  protocol = connected_protocol()
+  feed(protocol, encode(MESSAGES), 1)
+  assert received(protocol) == MESSAGES
+
+@run_async
+async def test_bytes_payloads():
+  # bytes aren't Jsonable, but msgpack carries them through unchanged
+  payloads = [b"", b"raw", bytes(range(256))]
+  protocol = connected_protocol()
+  feed(protocol, encode(payloads), 7)
+  assert received(protocol) == payloads
+
+@run_async
+async def test_coalesced_frames_in_one_read():
+  protocol = connected_protocol()
+  data = encode(MESSAGES * 3)
+  buf = protocol.get_buffer(-1)
+  buf[:len(data)] = data
+  protocol.buffer_updated(len(data))
+  assert received(protocol) == MESSAGES * 3
+
+@run_async
+async def test_eof_mid_frame_reads_none_repeatedly():
+  protocol = connected_protocol()
+  data = encode(["complete", "truncated"])
+  feed(protocol, data[:-3], len(data))
+  protocol.connection_lost(None)
+  assert HijackClient._decoder.decode(await protocol.read_frame()) == "complete"
+  assert await protocol.read_frame() is None
+  assert await protocol.read_frame() is None
+
+@run_async
+async def test_eof_leaves_connection_open_for_replies():
+  transport = FakeTransport()
+  protocol = _HijackProtocol()
+  protocol.connection_made(transport)
+  feed(protocol, encode(["hi"]), 4096)
+  assert protocol.eof_received()
+  assert HijackClient._decoder.decode(await protocol.read_frame()) == "hi"
+  assert await protocol.read_frame() is None
+  protocol.write(b"reply")
+  assert transport.written == b"reply"
+  assert not transport.closed
+  protocol.connection_lost(None)
+  assert await protocol.read_frame() is None
+  assert protocol._incoming.qsize() == 1
+
+@pytest.mark.parametrize("chunk_size", [1000, 4096, 65536, 10 ** 7])
+@run_async
+async def test_large_frames(chunk_size):
+  msgs = ["a" * (_HijackProtocol._recv_size - 10), "small", b"b" * 300000, "c" * (3 * _HijackProtocol._recv_size), 1]
+  protocol = connected_protocol()
+  feed(protocol, encode(msgs), chunk_size)
+  assert received(protocol) == msgs
+  assert protocol._large_frame is None
+  assert not protocol._pending
+
+@run_async
+async def test_large_frame_header_alone_allocates_little():
+  # Just claiming a huge frame must not be enough to make us allocate it, as anyone can connect and send a header
+  protocols = [connected_protocol() for _ in range(20)]
+  tracemalloc.start()
+  try:
+    for protocol in protocols:
+      feed(protocol, _frame_header.pack(_HijackProtocol._max_frame_size), _frame_header.size)
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  assert peak < len(protocols) * 4 * _HijackProtocol._recv_size
+
+@run_async
+async def test_large_frame_buffer_grows_with_received_data():
+  protocol = connected_protocol()
+  body = b"x" * (1024 * 1024)
+  feed(protocol, _frame_header.pack(_HijackProtocol._max_frame_size) + body, 4096)
+  assert protocol._large_received == len(body)
+  assert len(protocol._large_frame) <= 2 * len(body)
+
+@run_async
+async def test_reading_pauses_while_frames_are_unread():
+  protocol = connected_protocol()
+  transport = protocol._transport
+  frame = b"x" * 100000
+  feed(protocol, encode([frame]), 4096)
+  assert transport.reading
+  feed(protocol, encode([frame]), 4096)
+  assert not transport.reading
+  # One frame left is still more than half the limit
+  assert HijackClient._decoder.decode(await protocol.read_frame()) == frame
+  assert not transport.reading
+  assert HijackClient._decoder.decode(await protocol.read_frame()) == frame
+  assert transport.reading
+  assert protocol._queued == 0
+
+@run_async
+async def test_many_small_unread_frames_pause_reading():
+  protocol = connected_protocol()
+  feed(protocol, encode(["y" * 1000] * 200), 65536)
+  assert not protocol._transport.reading
+  while protocol._queued > _HijackProtocol._queue_high // 2:
+    await protocol.read_frame()
+  assert protocol._transport.reading
+
+@run_async
+async def test_oversized_frame_aborts_connection():
+  protocol = connected_protocol()
+  feed(protocol, encode(["fine"]) + _frame_header.pack(_HijackProtocol._max_frame_size + 1) + b"z" * 100, 4096)
+  assert protocol._transport.closed
+  assert protocol._large_frame is None
+  assert HijackClient._decoder.decode(await protocol.read_frame()) == "fine"
+
+@run_async
+async def test_drain_waits_for_resume_writing():
+  protocol = _HijackProtocol()
+  protocol.connection_made(FakeTransport())
+  await protocol.drain()
+  protocol.pause_writing()
+  assert protocol.write_blocked
+  drain = asyncio.ensure_future(protocol.drain())
+  await asyncio.sleep(0)
+  assert not drain.done()
+  protocol.resume_writing()
+  await asyncio.wait_for(drain, 1)
+
+@run_async
+async def test_connection_lost_fails_writers():
+  protocol = _HijackProtocol()
+  protocol.connection_made(FakeTransport())
+  protocol.pause_writing()
+  drain = asyncio.ensure_future(protocol.drain())
+  await asyncio.sleep(0)
+  protocol.connection_lost(None)
+  with pytest.raises(ConnectionResetError):
+    await drain
+  with pytest.raises(ConnectionResetError):
+    await protocol.drain()
+  with pytest.raises(ConnectionResetError):
+    protocol.write(b"late")
+  assert await protocol.read_frame() is None
+
+@run_async
+async def test_failed_handler_closes_connection():
+  errors = []
+  asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context["exception"]))
+
+  async def handler(protocol):
+    raise KeyError("lobby")
+
+  transport = FakeTransport()
+  protocol = _HijackProtocol(handler)
+  protocol.connection_made(transport)
+  await asyncio.sleep(0)
+  await asyncio.sleep(0)
+  assert transport.closed
+  assert len(errors) == 1
+  assert isinstance(errors[0], KeyError)